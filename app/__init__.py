@@ -1,10 +1,43 @@
+import atexit
 import os
+
+import click
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 未導入時は Flask 標準の JSON 変換を使う
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # jsonify / request.get_json の変換を C 実装の orjson で行う
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key')
+if orjson:
+    app.json = OrjsonProvider(app)
+# フロントの Web サーバーに PDF の送信を任せる（Apache mod_xsendfile / nginx の X-Accel-Redirect）
+app.use_x_sendfile = (
+    os.environ.get('USE_X_SENDFILE') == '1' or bool(os.environ.get('X_ACCEL_REDIRECT_PREFIX'))
+)
 
 from app import db  # noqa: E402  pylint: disable=wrong-import-position
 from app import main  # noqa: E402  pylint: disable=wrong-import-position
 
-db.create_table()
\ No newline at end of file
+
+@app.cli.command('init-db')
+def init_db_command():
+    db.create_table()
+    click.echo('データベースを初期化しました。')
+
+
+db.ensure_schema()
+atexit.register(db.optimize_and_close)
\ No newline at end of file
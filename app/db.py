@@ -1,159 +1,598 @@
 import os
 import sqlite3
+import hashlib
 import json
-from datetime import datetime
-from typing import Dict, List, Optional
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - wheel を導入できない環境では標準の json を使う
+    orjson = None
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 DATABASE = os.path.join(BASE_DIR, 'database.db')
 
 
-def create_table() -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
+def _dumps_json(obj: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _loads_json(data: bytes | str) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# 用語生成ジョブの状態を残しておく期間（保守スレッドがこれより古いものを削除する）
+GLOSSARY_JOB_RETENTION = timedelta(days=1)
+# Gemini 応答キャッシュの保持期間（これより古い応答は保守スレッドが削除する）
+LLM_CACHE_MAX_AGE = timedelta(days=30)
+
+# create_table の移行処理を追加したら合わせて更新する
+SCHEMA_VERSION = 9
+
+# 接続ごとに必要な PRAGMA（journal_mode=WAL は DB ファイルに永続化されるので create_table で一度だけ設定）
+_CONNECTION_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA busy_timeout=5000;
+PRAGMA wal_autocheckpoint=1000;
+"""
+
+
+# SQLite の接続はスレッドをまたいで共有できないため、スレッドごとに 1 本をリクエストをまたいで使い回す
+_local = threading.local()
+# スレッド -> 接続。終了したスレッドの接続は次に新しい接続を開くときに閉じる
+_connections: Dict[threading.Thread, sqlite3.Connection] = {}
+_connections_lock = threading.Lock()
+# 接続を管理しているプロセス。fork 後の最初の _connect で切り替え、保守スレッドもプロセスごとに起動する
+_connections_pid: Optional[int] = None
+# fork 元から引き継いだ接続。子プロセスで閉じると親の WAL を壊しうるため、参照を持ったまま使わずに置いておく
+_inherited_connections: List[sqlite3.Connection] = []
+
+
+def _connect() -> sqlite3.Connection:
+    global _connections_pid
+    if _connections_pid != os.getpid():
+        with _connections_lock:
+            first_in_process = _connections_pid != os.getpid()
+            if first_in_process:
+                _inherited_connections.extend(_connections.values())
+                _connections.clear()
+                _connections_pid = os.getpid()
+        if first_in_process:
+            _start_maintenance_thread()
+    con = getattr(_local, 'con', None)
+    if con is None or _local.pid != os.getpid():
+        _close_dead_connections()
+        # 持ち主のスレッドが終了した後に別スレッドから閉じるため check_same_thread は無効にする
+        con = sqlite3.connect(DATABASE, cached_statements=256, check_same_thread=False)
+        con.executescript(_CONNECTION_PRAGMAS)
+        con.row_factory = sqlite3.Row
+        _local.con = con
+        _local.pid = os.getpid()
+        with _connections_lock:
+            _connections[threading.current_thread()] = con
+    return con
+
+
+def _close_dead_connections() -> None:
+    with _connections_lock:
+        dead = [thread for thread in _connections if not thread.is_alive()]
+        cons = [_connections.pop(thread) for thread in dead]
+    for con in cons:
+        _close(con)
+
+
+def _close(con: sqlite3.Connection) -> None:
+    # その接続で実行したクエリをもとに統計情報を更新してから閉じる
+    try:
+        con.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass
+    con.close()
+
+
+def close_connection() -> None:
+    con = getattr(_local, 'con', None)
+    if con is not None:
+        _local.con = None
+        with _connections_lock:
+            if _connections.get(threading.current_thread()) is con:
+                del _connections[threading.current_thread()]
+        if _local.pid == os.getpid():
+            _close(con)
+        else:
+            _inherited_connections.append(con)
+
+
+# 単一行の参照（資料・ノート）をプロセス内で保持する LRU キャッシュ。
+# このモジュールの書き込み関数で無効化するほか、他の接続（別スレッド・別ワーカープロセス）がコミットした場合は
+# PRAGMA data_version の変化を検知して丸ごと破棄する
+_ROW_CACHE_MAXSIZE = 512
+_row_cache_lock = threading.Lock()
+_pdf_cache: OrderedDict[str, Dict[str, str]] = OrderedDict()
+_note_cache: OrderedDict[str, Dict[str, str]] = OrderedDict()
+# 無効化のたびに増やす世代番号。読み取り中に書き込みが挟まった場合、古い行をキャッシュに戻さないために使う。
+# キーは両キャッシュ共通（lecture_id）で、片方の無効化でもう片方の格納が見送られるだけなので害はない
+_cache_generations: Dict[str, int] = {}
+# キャッシュを丸ごと破棄するたびに増やす番号（全キーの世代番号を一度に進める代わり）
+_cache_epoch = 0
+# data_version 監視専用の接続。自分では書き込まないので、どの接続のコミットでも値が変わる
+_watch_con: Optional[sqlite3.Connection] = None
+_watch_pid: Optional[int] = None
+_watch_version: Optional[int] = None
+
+
+def _sync_row_cache() -> None:
+    # _row_cache_lock を保持した状態で呼ぶ
+    global _cache_epoch, _watch_con, _watch_pid, _watch_version
+    if _watch_pid != os.getpid():
+        if _watch_con is not None:
+            _inherited_connections.append(_watch_con)
+        _watch_con = sqlite3.connect(DATABASE, check_same_thread=False)
+        _watch_pid = os.getpid()
+        _watch_version = None
+    try:
+        version = _watch_con.execute("PRAGMA data_version").fetchone()[0]
+    except sqlite3.Error:
+        version = None
+    if version is None or version != _watch_version:
+        _pdf_cache.clear()
+        _note_cache.clear()
+        _cache_epoch += 1
+        _watch_version = version
+
+
+def _cache_get(cache: OrderedDict[str, Dict[str, str]], key: str) -> Optional[Dict[str, str]]:
+    with _row_cache_lock:
+        _sync_row_cache()
+        value = cache.get(key)
+        if value is None:
+            return None
+        cache.move_to_end(key)
+        return dict(value)
+
+
+def _cache_generation(key: str) -> Tuple[int, int]:
+    with _row_cache_lock:
+        return _cache_epoch, _cache_generations.get(key, 0)
+
+
+def _cache_put(
+    cache: OrderedDict[str, Dict[str, str]], key: str, value: Dict[str, str], generation: Tuple[int, int]
+) -> None:
+    with _row_cache_lock:
+        # 読み取り開始後に無効化されていれば、読んだ行は古い可能性があるので格納しない
+        if (_cache_epoch, _cache_generations.get(key, 0)) != generation:
+            return
+        cache[key] = dict(value)
+        cache.move_to_end(key)
+        if len(cache) > _ROW_CACHE_MAXSIZE:
+            cache.popitem(last=False)
+
+
+def _cache_invalidate(cache: OrderedDict[str, Dict[str, str]], key: str) -> None:
+    with _row_cache_lock:
+        cache.pop(key, None)
+        _cache_generations[key] = _cache_generations.get(key, 0) + 1
+
+
+def maintenance_checkpoint() -> None:
+    # 書き込みが続くと -wal ファイルが肥大化するので、定期的に本体へ書き戻して切り詰める
+    _connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def _start_maintenance_thread(interval: float = 300.0) -> threading.Thread:
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                maintenance_checkpoint()
+                now = datetime.now(timezone.utc)
+                prune_glossary_jobs(now - GLOSSARY_JOB_RETENTION)
+                prune_llm_cache(now - LLM_CACHE_MAX_AGE)
+            except sqlite3.Error:
+                # 他の接続が読み取り中などで失敗しても次回に再試行する
+                pass
+
+    thread = threading.Thread(target=run, name='db-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+
+def optimize_and_close() -> None:
+    # プロセス終了時に、このスレッドと終了済みスレッドの接続を PRAGMA optimize してから閉じる
+    global _watch_con, _watch_pid
+    close_connection()
+    _close_dead_connections()
+    with _row_cache_lock:
+        if _watch_con is not None and _watch_pid == os.getpid():
+            _watch_con.close()
+        _watch_con = None
+        _watch_pid = None
+
+
+def _term_def_hash(term: str, definition: str) -> bytes:
+    # 長い解説文を UNIQUE 索引に含めないよう、固定長 16 バイトのハッシュで重複判定する
+    return hashlib.blake2b(f"{term}\x00{definition}".encode('utf-8'), digest_size=16).digest()
+
+
+# STRICT テーブルは SQLite 3.37 以降でのみ利用できる
+_STRICT_TABLES = sqlite3.sqlite_version_info >= (3, 37, 0)
+
+# 時刻はすべて UNIX エポックからのマイクロ秒（INTEGER）で保存する
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# テーブル名 -> (列定義, テーブルオプション)
+_TABLE_SCHEMAS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    'lecture_files': (
         """
-        CREATE TABLE IF NOT EXISTS lecture_files (
             lecture_id        TEXT PRIMARY KEY,
             original_filename TEXT NOT NULL,
             stored_filename   TEXT NOT NULL,
-            uploaded_at       TEXT NOT NULL
-        )
-        """
-    )
-
-    con.execute(
+            uploaded_at       INTEGER NOT NULL,
+            page_count        INTEGER
+        """,
+        (),
+    ),
+    'lecture_notes': (
         """
-        CREATE TABLE IF NOT EXISTS lecture_notes (
             lecture_id  TEXT PRIMARY KEY,
             content     TEXT NOT NULL,
-            updated_at  TEXT NOT NULL
-        )
-        """
-    )
-
-    con.execute(
+            updated_at  INTEGER NOT NULL
+        """,
+        (),
+    ),
+    'lecture_glossary_cache': (
         """
-        CREATE TABLE IF NOT EXISTS lecture_glossary_cache (
             lecture_id  TEXT NOT NULL,
             page_key    TEXT NOT NULL,
-            items_json  TEXT NOT NULL,
-            updated_at  TEXT NOT NULL,
+            items_json  BLOB NOT NULL,
+            updated_at  INTEGER NOT NULL,
             PRIMARY KEY (lecture_id, page_key)
-        )
-        """
-    )
-
-    con.execute(
+        """,
+        (),
+    ),
+    'lecture_note_images': (
         """
-        CREATE TABLE IF NOT EXISTS lecture_note_images (
             image_id          TEXT PRIMARY KEY,
             lecture_id        TEXT NOT NULL,
             original_filename TEXT NOT NULL,
             stored_filename   TEXT NOT NULL,
-            uploaded_at       TEXT NOT NULL
-        )
-        """
-    )
-
-    con.execute(
+            uploaded_at       INTEGER NOT NULL
+        """,
+        (),
+    ),
+    'glossary_dictionary': (
         """
-        CREATE TABLE IF NOT EXISTS glossary_dictionary (
             dictionary_id TEXT PRIMARY KEY,
             lecture_id    TEXT NOT NULL,
             term          TEXT NOT NULL,
             definition    TEXT NOT NULL,
             context       TEXT,
-            saved_at      TEXT NOT NULL,
-            UNIQUE (lecture_id, term, definition)
-        )
-        """
-    )
-
-    con.execute(
+            saved_at      INTEGER NOT NULL,
+            term_def_hash BLOB NOT NULL,
+            UNIQUE (lecture_id, term_def_hash)
+        """,
+        (),
+    ),
+    'lecture_chat_messages': (
         """
-        CREATE TABLE IF NOT EXISTS lecture_chat_messages (
-            message_id  TEXT PRIMARY KEY,
+            message_id  TEXT NOT NULL,
             lecture_id  TEXT NOT NULL,
             role        TEXT NOT NULL,
             content     TEXT NOT NULL,
-            created_at  TEXT NOT NULL,
-            category    TEXT NOT NULL DEFAULT 'free'
-        )
+            created_at  INTEGER NOT NULL,
+            category    TEXT NOT NULL DEFAULT 'free',
+            PRIMARY KEY (lecture_id, category, created_at, message_id)
+        """,
+        ('WITHOUT ROWID',),
+    ),
+    'llm_response_cache': (
         """
-    )
+            cache_key   TEXT PRIMARY KEY,
+            items_json  BLOB NOT NULL,
+            created_at  INTEGER NOT NULL
+        """,
+        (),
+    ),
+    # 用語生成ジョブの状態。複数ワーカーのどれにポーリングが届いても参照できるよう DB に置く
+    'glossary_jobs': (
+        """
+            job_id      TEXT PRIMARY KEY,
+            lecture_id  TEXT NOT NULL,
+            page_key    TEXT NOT NULL,
+            refresh     INTEGER NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'pending',
+            error       TEXT,
+            error_code  INTEGER,
+            created_at  INTEGER NOT NULL
+        """,
+        (),
+    ),
+}
+
+# 各テーブルの時刻列
+_TIMESTAMP_COLUMNS = {
+    'lecture_files': 'uploaded_at',
+    'lecture_notes': 'updated_at',
+    'lecture_glossary_cache': 'updated_at',
+    'lecture_note_images': 'uploaded_at',
+    'glossary_dictionary': 'saved_at',
+    'lecture_chat_messages': 'created_at',
+    'llm_response_cache': 'created_at',
+    'glossary_jobs': 'created_at',
+}
+_TIMESTAMP_KEYS = frozenset(_TIMESTAMP_COLUMNS.values())
+
+# 一覧系クエリの WHERE lecture_id = ? ORDER BY ... を索引で処理する
+# （lecture_chat_messages は主キーがこの順序を兼ねる）
+_INDEX_SCRIPT = """
+CREATE INDEX IF NOT EXISTS idx_files_uploaded
+    ON lecture_files (uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS idx_note_images_lecture_time
+    ON lecture_note_images (lecture_id, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS idx_gloss_dict_lecture_saved
+    ON glossary_dictionary (lecture_id, saved_at DESC);
+"""
+
+
+def _table_ddl(table: str, name: Optional[str] = None) -> str:
+    columns, options = _TABLE_SCHEMAS[table]
+    if _STRICT_TABLES:
+        options = options + ('STRICT',)
+    return f"CREATE TABLE IF NOT EXISTS {name or table} ({columns}) {', '.join(options)}"
+
+
+def _to_epoch_us(value: datetime) -> int:
+    # タイムゾーンなしの値はローカル時刻として扱う
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _format_timestamp(value: int) -> str:
+    return (_EPOCH + timedelta(microseconds=value)).astimezone().isoformat()
+
+
+def _iso_to_epoch_us(value: Any) -> int:
+    # 旧形式（ISO 8601 文字列）の時刻を移行するための SQL 関数
+    if isinstance(value, int):
+        return value
     try:
-        con.execute("ALTER TABLE lecture_chat_messages ADD COLUMN category TEXT NOT NULL DEFAULT 'free'")
-    except sqlite3.OperationalError:
-        # 既に列が存在する場合は無視
-        pass
-    con.commit()
-    con.close()
+        return _to_epoch_us(datetime.fromisoformat(str(value).replace('Z', '+00:00')))
+    except ValueError:
+        return 0
 
 
-def insert_pdf(lecture_id: str, original_filename: str, stored_filename: str, uploaded_at: datetime) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
-        """
-        INSERT INTO lecture_files (lecture_id, original_filename, stored_filename, uploaded_at)
-        VALUES (?, ?, ?, ?)
-        """,
-        (lecture_id, original_filename, stored_filename, uploaded_at.isoformat())
+def _row_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    item = dict(row)
+    for key in _TIMESTAMP_KEYS.intersection(item):
+        item[key] = _format_timestamp(item[key])
+    return item
+
+
+def ensure_schema() -> None:
+    # 起動時は user_version の確認だけ行い、DB が未作成・旧版のときに限り create_table を実行する
+    try:
+        if os.path.exists(DATABASE):
+            version = _connect().execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+        create_table()
+    finally:
+        # import 時のスレッドの接続を残すと、gunicorn --preload などで fork 先に引き継がれてしまう
+        close_connection()
+
+
+def create_table() -> None:
+    con = _connect()
+    con.execute("PRAGMA journal_mode=WAL")
+    # DDL はまとめて 1 トランザクションで実行する
+    con.executescript(
+        "BEGIN IMMEDIATE;\n"
+        + "".join(_table_ddl(table) + ";\n" for table in _TABLE_SCHEMAS)
+        + "COMMIT;"
     )
-    con.commit()
-    con.close()
+
+    # スキーマの移行は PRAGMA user_version で管理し、各バージョンにつき一度だけ実行する
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        columns = {row[1] for row in con.execute("PRAGMA table_info(lecture_chat_messages)")}
+        migration = "BEGIN IMMEDIATE;\n"
+        if 'category' not in columns:
+            # category 列追加前に作成された DB 向け
+            migration += "ALTER TABLE lecture_chat_messages ADD COLUMN category TEXT NOT NULL DEFAULT 'free';\n"
+        migration += "PRAGMA user_version = 1;\nCOMMIT;"
+        con.executescript(migration)
+
+    if version < 2:
+        con.executescript("BEGIN IMMEDIATE;\n" + _INDEX_SCRIPT + "PRAGMA user_version = 2;\nCOMMIT;")
+
+    if version < 3:
+        columns = {row[1] for row in con.execute("PRAGMA table_info(glossary_dictionary)")}
+        migration = "BEGIN IMMEDIATE;\n"
+        if 'term_def_hash' not in columns:
+            # UNIQUE (lecture_id, term, definition) は削除できないため、ハッシュ列付きのテーブルに作り直す
+            con.create_function('term_def_hash', 2, _term_def_hash, deterministic=True)
+            migration += """
+            CREATE TABLE glossary_dictionary_new (
+                dictionary_id TEXT PRIMARY KEY,
+                lecture_id    TEXT NOT NULL,
+                term          TEXT NOT NULL,
+                definition    TEXT NOT NULL,
+                context       TEXT,
+                saved_at      TEXT NOT NULL,
+                term_def_hash BLOB NOT NULL,
+                UNIQUE (lecture_id, term_def_hash)
+            );
+            INSERT INTO glossary_dictionary_new
+                (dictionary_id, lecture_id, term, definition, context, saved_at, term_def_hash)
+            SELECT dictionary_id, lecture_id, term, definition, context, saved_at, term_def_hash(term, definition)
+            FROM glossary_dictionary;
+            DROP TABLE glossary_dictionary;
+            ALTER TABLE glossary_dictionary_new RENAME TO glossary_dictionary;
+            CREATE INDEX IF NOT EXISTS idx_gloss_dict_lecture_saved
+                ON glossary_dictionary (lecture_id, saved_at DESC);
+            """
+        migration += "PRAGMA user_version = 3;\nCOMMIT;"
+        con.executescript(migration)
+
+    if version < 4:
+        table_sql = con.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'lecture_chat_messages'"
+        ).fetchone()[0]
+        migration = "BEGIN IMMEDIATE;\n"
+        if 'WITHOUT ROWID' not in table_sql.upper():
+            # 講義・カテゴリ・時刻順の主キーで行を格納し直し、一覧取得を主キーの範囲走査にする
+            migration += """
+            CREATE TABLE lecture_chat_messages_new (
+                message_id  TEXT NOT NULL,
+                lecture_id  TEXT NOT NULL,
+                role        TEXT NOT NULL,
+                content     TEXT NOT NULL,
+                created_at  TEXT NOT NULL,
+                category    TEXT NOT NULL DEFAULT 'free',
+                PRIMARY KEY (lecture_id, category, created_at, message_id)
+            ) WITHOUT ROWID;
+            INSERT INTO lecture_chat_messages_new
+                (message_id, lecture_id, role, content, created_at, category)
+            SELECT message_id, lecture_id, role, content, created_at, category
+            FROM lecture_chat_messages;
+            DROP TABLE lecture_chat_messages;
+            ALTER TABLE lecture_chat_messages_new RENAME TO lecture_chat_messages;
+            """
+        migration += "DROP INDEX IF EXISTS idx_chat_lecture_cat_time;\nPRAGMA user_version = 4;\nCOMMIT;"
+        con.executescript(migration)
+
+    if version < 5:
+        # v5（チャット表の created_at への既定値付与）は廃止。既存の時刻は v6 でマイクロ秒のまま変換する
+        con.execute("PRAGMA user_version = 5")
+
+    if version < 6:
+        # *_at 列を INTEGER（UNIX エポックからのマイクロ秒）に変え、STRICT テーブルとして作り直す
+        con.create_function('epoch_us', 1, _iso_to_epoch_us, deterministic=True)
+        migration = "BEGIN IMMEDIATE;\n"
+        for table, timestamp_column in _TIMESTAMP_COLUMNS.items():
+            table_info = con.execute(f"PRAGMA table_info({table})").fetchall()
+            if any(row[1] == timestamp_column and row[2].upper() == 'INTEGER' for row in table_info):
+                continue
+            columns = [row[1] for row in table_info]
+            values = [
+                f"epoch_us({column})" if column == timestamp_column
+                else f"CAST({column} AS BLOB)" if column == 'items_json'
+                else column
+                for column in columns
+            ]
+            migration += _table_ddl(table, f"{table}_new") + ";\n"
+            migration += (
+                f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table};\n"
+                f"DROP TABLE {table};\n"
+                f"ALTER TABLE {table}_new RENAME TO {table};\n"
+            )
+        migration += _INDEX_SCRIPT + "PRAGMA user_version = 6;\nCOMMIT;"
+        con.executescript(migration)
+
+    if version < 7:
+        columns = {row[1] for row in con.execute("PRAGMA table_info(lecture_files)")}
+        migration = "BEGIN IMMEDIATE;\n"
+        if 'page_count' not in columns:
+            # 既存の行は NULL のままにし、初回閲覧時に補完する
+            migration += "ALTER TABLE lecture_files ADD COLUMN page_count INTEGER;\n"
+        migration += "PRAGMA user_version = 7;\nCOMMIT;"
+        con.executescript(migration)
+
+    if version < 8:
+        # llm_response_cache は上の CREATE TABLE IF NOT EXISTS で作成済み
+        con.executescript("BEGIN IMMEDIATE;\nPRAGMA user_version = 8;\nCOMMIT;")
+
+    if version < 9:
+        # glossary_jobs も上の CREATE TABLE IF NOT EXISTS で作成済み
+        con.executescript("BEGIN IMMEDIATE;\nPRAGMA user_version = 9;\nCOMMIT;")
+
+
+def insert_pdf(
+    lecture_id: str,
+    original_filename: str,
+    stored_filename: str,
+    uploaded_at: datetime,
+    page_count: Optional[int] = None,
+) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO lecture_files (lecture_id, original_filename, stored_filename, uploaded_at, page_count)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (lecture_id, original_filename, stored_filename, _to_epoch_us(uploaded_at), page_count)
+        )
+    _cache_invalidate(_pdf_cache, lecture_id)
 
 
-def get_all_pdfs() -> List[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+def list_lectures_with_counts() -> List[Dict[str, Any]]:
+    # 資料一覧とチャット・ノート画像の件数を 1 回のクエリでまとめて取得する
+    con = _connect()
     cursor = con.cursor()
     cursor.execute(
         """
-        SELECT lecture_id, original_filename, stored_filename, uploaded_at
-        FROM lecture_files
-        ORDER BY uploaded_at DESC
+        SELECT f.lecture_id,
+               f.original_filename,
+               f.stored_filename,
+               f.uploaded_at,
+               (SELECT COUNT(*) FROM lecture_chat_messages c WHERE c.lecture_id = f.lecture_id) AS chat_count,
+               (SELECT COUNT(*) FROM lecture_note_images i WHERE i.lecture_id = f.lecture_id) AS image_count
+        FROM lecture_files f
+        ORDER BY f.uploaded_at DESC
         """
     )
     rows = cursor.fetchall()
-    con.close()
 
-    return [
-        {
-            'lecture_id': row[0],
-            'original_filename': row[1],
-            'stored_filename': row[2],
-            'uploaded_at': row[3],
-        }
-        for row in rows
-    ]
+    return [_row_dict(row) for row in rows]
+
 
+def get_pdf_by_id(lecture_id: str) -> Optional[Dict[str, Any]]:
+    cached = _cache_get(_pdf_cache, lecture_id)
+    if cached is not None:
+        return cached
+    generation = _cache_generation(lecture_id)
 
-def get_pdf_by_id(lecture_id: str) -> Optional[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    con = _connect()
     cursor = con.cursor()
     cursor.execute(
         """
-        SELECT lecture_id, original_filename, stored_filename, uploaded_at
+        SELECT lecture_id, original_filename, stored_filename, uploaded_at, page_count
         FROM lecture_files
         WHERE lecture_id = ?
         """,
         (lecture_id,)
     )
     row = cursor.fetchone()
-    con.close()
 
     if not row:
         return None
 
-    return {
-        'lecture_id': row[0],
-        'original_filename': row[1],
-        'stored_filename': row[2],
-        'uploaded_at': row[3],
-    }
+    pdf = _row_dict(row)
+    _cache_put(_pdf_cache, lecture_id, pdf, generation)
+    return pdf
 
 
 def get_note_for_lecture(lecture_id: str) -> Optional[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    cached = _cache_get(_note_cache, lecture_id)
+    if cached is not None:
+        return cached
+    generation = _cache_generation(lecture_id)
+
+    con = _connect()
     cursor = con.cursor()
     cursor.execute(
         """
@@ -164,32 +603,30 @@ def get_note_for_lecture(lecture_id: str) -> Optional[Dict[str, str]]:
         (lecture_id,),
     )
     row = cursor.fetchone()
-    con.close()
     if not row:
         return None
-    return {
-        'content': row[0],
-        'updated_at': row[1],
-    }
+    note = _row_dict(row)
+    _cache_put(_note_cache, lecture_id, note, generation)
+    return note
 
 
 def upsert_note_for_lecture(lecture_id: str, content: str, updated_at: datetime) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
-        """
-        INSERT INTO lecture_notes (lecture_id, content, updated_at)
-        VALUES (?, ?, ?)
-        ON CONFLICT(lecture_id)
-        DO UPDATE SET content = excluded.content, updated_at = excluded.updated_at
-        """,
-        (lecture_id, content, updated_at.isoformat()),
-    )
-    con.commit()
-    con.close()
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO lecture_notes (lecture_id, content, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(lecture_id)
+            DO UPDATE SET content = excluded.content, updated_at = excluded.updated_at
+            """,
+            (lecture_id, content, _to_epoch_us(updated_at)),
+        )
+    _cache_invalidate(_note_cache, lecture_id)
 
 
 def get_glossary_cache(lecture_id: str, page_key: str) -> Optional[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    con = _connect()
     cursor = con.cursor()
     cursor.execute(
         """
@@ -200,64 +637,183 @@ def get_glossary_cache(lecture_id: str, page_key: str) -> Optional[Dict[str, str
         (lecture_id, page_key),
     )
     row = cursor.fetchone()
-    con.close()
     if not row:
         return None
     try:
-        items = json.loads(row[0])
+        items = _loads_json(row[0])
     except json.JSONDecodeError:
         items = []
     return {
         'items': items,
-        'updated_at': row[1],
+        'updated_at': _format_timestamp(row[1]),
     }
 
 
-def upsert_glossary_cache(lecture_id: str, page_key: str, items: List[Dict[str, str]], updated_at: datetime) -> None:
-    con = sqlite3.connect(DATABASE)
-    payload = json.dumps(items, ensure_ascii=False)
-    con.execute(
+def upsert_glossary_cache(lecture_id: str, page_key: str, items: List[Dict[str, str]], updated_at: datetime) -> bool:
+    # 生成中に資料が削除された場合に備え、資料が残っているときだけ保存する（保存できたかを返す）
+    payload = _dumps_json(items)
+    con = _connect()
+    with con:
+        cursor = con.execute(
+            """
+            INSERT INTO lecture_glossary_cache (lecture_id, page_key, items_json, updated_at)
+            SELECT ?, ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM lecture_files WHERE lecture_id = ?)
+            ON CONFLICT(lecture_id, page_key)
+            DO UPDATE SET items_json = excluded.items_json, updated_at = excluded.updated_at
+            """,
+            (lecture_id, page_key, payload, _to_epoch_us(updated_at), lecture_id),
+        )
+    return cursor.rowcount > 0
+
+
+def get_llm_cache(cache_key: str) -> Optional[List[Dict[str, Any]]]:
+    con = _connect()
+    cursor = con.cursor()
+    cursor.execute(
         """
-        INSERT INTO lecture_glossary_cache (lecture_id, page_key, items_json, updated_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(lecture_id, page_key)
-        DO UPDATE SET items_json = excluded.items_json, updated_at = excluded.updated_at
+        SELECT items_json
+        FROM llm_response_cache
+        WHERE cache_key = ?
         """,
-        (lecture_id, page_key, payload, updated_at.isoformat()),
+        (cache_key,),
     )
-    con.commit()
-    con.close()
+    row = cursor.fetchone()
+    if not row:
+        return None
+    try:
+        return _loads_json(row[0])
+    except json.JSONDecodeError:
+        return None
 
 
-def update_pdf_filename(lecture_id: str, new_name: str) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
+def set_llm_cache(cache_key: str, items: List[Dict[str, Any]], created_at: datetime) -> None:
+    payload = _dumps_json(items)
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO llm_response_cache (cache_key, items_json, created_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(cache_key)
+            DO UPDATE SET items_json = excluded.items_json, created_at = excluded.created_at
+            """,
+            (cache_key, payload, _to_epoch_us(created_at)),
+        )
+
+
+def insert_glossary_job(job_id: str, lecture_id: str, page_key: str, refresh: bool, created_at: datetime) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO glossary_jobs (job_id, lecture_id, page_key, refresh, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (job_id, lecture_id, page_key, int(refresh), _to_epoch_us(created_at)),
+        )
+
+
+def find_pending_glossary_job(lecture_id: str, page_key: str, refresh: bool, since: datetime) -> Optional[str]:
+    # since より前に作られたまま終わっていないジョブは、処理していたワーカーが落ちたものとみなして使わない
+    con = _connect()
+    cursor = con.cursor()
+    cursor.execute(
         """
-        UPDATE lecture_files
-        SET original_filename = ?
-        WHERE lecture_id = ?
+        SELECT job_id
+        FROM glossary_jobs
+        WHERE lecture_id = ? AND page_key = ? AND refresh = ? AND status = 'pending' AND created_at >= ?
+        ORDER BY created_at DESC
+        LIMIT 1
         """,
-        (new_name, lecture_id),
+        (lecture_id, page_key, int(refresh), _to_epoch_us(since)),
     )
-    con.commit()
-    con.close()
+    row = cursor.fetchone()
+    return row[0] if row else None
 
 
-def insert_note_image(lecture_id: str, image_id: str, original_filename: str, stored_filename: str, uploaded_at: datetime) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
+def finish_glossary_job(job_id: str, error: Optional[str] = None, error_code: Optional[int] = None) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            UPDATE glossary_jobs
+            SET status = ?, error = ?, error_code = ?
+            WHERE job_id = ?
+            """,
+            ('error' if error else 'done', error, error_code, job_id),
+        )
+
+
+def prune_glossary_jobs(before: datetime) -> None:
+    con = _connect()
+    with con:
+        con.execute("DELETE FROM glossary_jobs WHERE created_at < ?", (_to_epoch_us(before),))
+
+
+def get_glossary_job(job_id: str) -> Optional[Dict[str, Any]]:
+    con = _connect()
+    cursor = con.cursor()
+    cursor.execute(
         """
-        INSERT INTO lecture_note_images (image_id, lecture_id, original_filename, stored_filename, uploaded_at)
-        VALUES (?, ?, ?, ?, ?)
+        SELECT job_id, lecture_id, page_key, status, error, error_code, created_at
+        FROM glossary_jobs
+        WHERE job_id = ?
         """,
-        (image_id, lecture_id, original_filename, stored_filename, uploaded_at.isoformat()),
+        (job_id,),
     )
-    con.commit()
-    con.close()
+    row = cursor.fetchone()
+    return _row_dict(row) if row else None
+
+
+def prune_llm_cache(before: datetime) -> None:
+    con = _connect()
+    with con:
+        con.execute("DELETE FROM llm_response_cache WHERE created_at < ?", (_to_epoch_us(before),))
+
+
+def update_pdf_filename(lecture_id: str, new_name: str) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            UPDATE lecture_files
+            SET original_filename = ?
+            WHERE lecture_id = ?
+            """,
+            (new_name, lecture_id),
+        )
+    _cache_invalidate(_pdf_cache, lecture_id)
+
+
+def update_pdf_page_count(lecture_id: str, page_count: int) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            UPDATE lecture_files
+            SET page_count = ?
+            WHERE lecture_id = ?
+            """,
+            (page_count, lecture_id),
+        )
+    _cache_invalidate(_pdf_cache, lecture_id)
+
+
+def insert_note_image(lecture_id: str, image_id: str, original_filename: str, stored_filename: str, uploaded_at: datetime) -> None:
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO lecture_note_images (image_id, lecture_id, original_filename, stored_filename, uploaded_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (image_id, lecture_id, original_filename, stored_filename, _to_epoch_us(uploaded_at)),
+        )
 
 
 def list_note_images(lecture_id: str) -> List[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    con = _connect()
     cursor = con.cursor()
     cursor.execute(
         """
@@ -269,17 +825,8 @@ def list_note_images(lecture_id: str) -> List[Dict[str, str]]:
         (lecture_id,),
     )
     rows = cursor.fetchall()
-    con.close()
 
-    return [
-        {
-            "image_id": row[0],
-            "original_filename": row[1],
-            "stored_filename": row[2],
-            "uploaded_at": row[3],
-        }
-        for row in rows
-    ]
+    return [_row_dict(row) for row in rows]
 
 
 def insert_chat_message(
@@ -290,38 +837,52 @@ def insert_chat_message(
     created_at: datetime,
     category: str = "free",
 ) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
-        """
-        INSERT INTO lecture_chat_messages (message_id, lecture_id, role, content, created_at, category)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (message_id, lecture_id, role, content, created_at.isoformat(), category),
-    )
-    con.commit()
-    con.close()
-
-
-def delete_chat_messages(lecture_id: str, category: Optional[str] = None) -> None:
-    con = sqlite3.connect(DATABASE)
-    if category:
+    con = _connect()
+    with con:
         con.execute(
             """
-            DELETE FROM lecture_chat_messages
-            WHERE lecture_id = ? AND category = ?
+            INSERT INTO lecture_chat_messages (message_id, lecture_id, role, content, created_at, category)
+            VALUES (?, ?, ?, ?, ?, ?)
             """,
-            (lecture_id, category),
+            (message_id, lecture_id, role, content, _to_epoch_us(created_at), category),
         )
-    else:
-        con.execute(
+
+
+def insert_chat_messages_many(items: List[Tuple[str, str, str, str, datetime, str]]) -> None:
+    # items は insert_chat_message と同じ引数順のタプル。1 トランザクションでまとめて挿入する
+    con = _connect()
+    with con:
+        con.executemany(
             """
-            DELETE FROM lecture_chat_messages
-            WHERE lecture_id = ?
+            INSERT INTO lecture_chat_messages (message_id, lecture_id, role, content, created_at, category)
+            VALUES (?, ?, ?, ?, ?, ?)
             """,
-            (lecture_id,),
+            [
+                (message_id, lecture_id, role, content, _to_epoch_us(created_at), category)
+                for lecture_id, message_id, role, content, created_at, category in items
+            ],
         )
-    con.commit()
-    con.close()
+
+
+def delete_chat_messages(lecture_id: str, category: Optional[str] = None) -> None:
+    con = _connect()
+    with con:
+        if category:
+            con.execute(
+                """
+                DELETE FROM lecture_chat_messages
+                WHERE lecture_id = ? AND category = ?
+                """,
+                (lecture_id, category),
+            )
+        else:
+            con.execute(
+                """
+                DELETE FROM lecture_chat_messages
+                WHERE lecture_id = ?
+                """,
+                (lecture_id,),
+            )
 
 
 def list_chat_messages(
@@ -329,7 +890,7 @@ def list_chat_messages(
     limit: Optional[int] = None,
     category: Optional[str] = None,
 ) -> List[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    con = _connect()
     cursor = con.cursor()
     query = (
         """
@@ -342,25 +903,19 @@ def list_chat_messages(
     if category:
         query += " AND category = ?"
         params.append(category)
-    query += " ORDER BY datetime(created_at) ASC"
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    con.close()
-
     if limit is not None:
-        rows = rows[-limit:]
+        # 新しい順に limit 件だけ取得し、古い順に並べ直す
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        rows.reverse()
+    else:
+        query += " ORDER BY created_at ASC"
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
 
-    return [
-        {
-            "message_id": row[0],
-            "lecture_id": row[1],
-            "role": row[2],
-            "content": row[3],
-            "created_at": row[4],
-            "category": row[5],
-        }
-        for row in rows
-    ]
+    return [_row_dict(row) for row in rows]
 
 
 def upsert_glossary_dictionary_item(
@@ -371,40 +926,46 @@ def upsert_glossary_dictionary_item(
     context: Optional[str],
     saved_at: datetime,
 ) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
-        """
-        INSERT INTO glossary_dictionary (dictionary_id, lecture_id, term, definition, context, saved_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT (lecture_id, term, definition)
-        DO UPDATE SET context = excluded.context,
-                      saved_at = excluded.saved_at,
-                      dictionary_id = excluded.dictionary_id
-        """,
-        (dictionary_id, lecture_id, term, definition, context, saved_at.isoformat()),
-    )
-    con.commit()
-    con.close()
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            INSERT INTO glossary_dictionary (dictionary_id, lecture_id, term, definition, context, saved_at, term_def_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (lecture_id, term_def_hash)
+            DO UPDATE SET context = excluded.context,
+                          saved_at = excluded.saved_at,
+                          dictionary_id = excluded.dictionary_id
+            """,
+            (
+                dictionary_id,
+                lecture_id,
+                term,
+                definition,
+                context,
+                _to_epoch_us(saved_at),
+                _term_def_hash(term, definition),
+            ),
+        )
 
 
 def delete_glossary_dictionary_item(dictionary_id: str) -> bool:
-    con = sqlite3.connect(DATABASE)
-    cursor = con.cursor()
-    cursor.execute(
-        """
-        DELETE FROM glossary_dictionary
-        WHERE dictionary_id = ?
-        """,
-        (dictionary_id,),
-    )
-    deleted = cursor.rowcount > 0
-    con.commit()
-    con.close()
+    con = _connect()
+    with con:
+        cursor = con.cursor()
+        cursor.execute(
+            """
+            DELETE FROM glossary_dictionary
+            WHERE dictionary_id = ?
+            """,
+            (dictionary_id,),
+        )
+        deleted = cursor.rowcount > 0
     return deleted
 
 
 def list_glossary_dictionary(lecture_id: Optional[str] = None) -> List[Dict[str, str]]:
-    con = sqlite3.connect(DATABASE)
+    con = _connect()
     cursor = con.cursor()
     if lecture_id:
         cursor.execute(
@@ -426,28 +987,24 @@ def list_glossary_dictionary(lecture_id: Optional[str] = None) -> List[Dict[str,
         )
 
     rows = cursor.fetchall()
-    con.close()
-    return [
-        {
-            "dictionary_id": row[0],
-            "lecture_id": row[1],
-            "term": row[2],
-            "definition": row[3],
-            "context": row[4],
-            "saved_at": row[5],
-        }
-        for row in rows
-    ]
+    return [_row_dict(row) for row in rows]
 
 
 def delete_pdf_record(lecture_id: str) -> None:
-    con = sqlite3.connect(DATABASE)
-    con.execute(
-        """
-        DELETE FROM lecture_files WHERE lecture_id = ?
-        """,
-        (lecture_id,),
-    )
-    con.commit()
-    con.close()
+    con = _connect()
+    with con:
+        con.execute(
+            """
+            DELETE FROM lecture_files WHERE lecture_id = ?
+            """,
+            (lecture_id,),
+        )
+        # 用語キャッシュは PDF 本文から生成されるため、資料と同じトランザクションで破棄する
+        con.execute(
+            """
+            DELETE FROM lecture_glossary_cache WHERE lecture_id = ?
+            """,
+            (lecture_id,),
+        )
+    _cache_invalidate(_pdf_cache, lecture_id)
 
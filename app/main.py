@@ -1,17 +1,27 @@
 from __future__ import annotations
 
+import glob
+import hashlib
 import json
 import os
 import re
+import shutil
+import threading
 import uuid
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List
 
 from app import app
 from app.db import (
     delete_pdf_record,
-    get_all_pdfs,
+    find_pending_glossary_job,
+    finish_glossary_job,
+    get_glossary_job,
+    insert_glossary_job,
+    list_lectures_with_counts,
     get_glossary_cache,
+    get_llm_cache,
     list_chat_messages,
     list_glossary_dictionary,
     list_note_images,
@@ -19,16 +29,19 @@ from app.db import (
     get_pdf_by_id,
     insert_pdf,
     insert_note_image,
-    insert_chat_message,
+    insert_chat_messages_many,
     delete_chat_messages,
+    set_llm_cache,
     upsert_glossary_cache,
     upsert_glossary_dictionary_item,
     upsert_note_for_lecture,
     update_pdf_filename,
+    update_pdf_page_count,
     delete_glossary_dictionary_item,
 )
 from flask import (
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
@@ -48,22 +61,78 @@ try:
 except ImportError:  # pragma: no cover
     PdfReader = None
 
-ALLOWED_EXTENSIONS = {".pdf"}
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 未導入時は標準の json を使う
+    orjson = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # pragma: no cover - 未導入時は PyPDF2 で解析する
+    pdfium = None
+
+# str.endswith にそのまま渡せるようタプルで持つ
+ALLOWED_EXTENSIONS = (".pdf",)
 ALLOWED_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
 UPLOAD_DIR = os.path.join(app.root_path, "static", "uploads", "pdfs")
 NOTE_IMAGE_DIR = os.path.join(app.root_path, "static", "uploads", "note_images")
+# 抽出済みテキストは公開する必要がないため static ではなく instance フォルダに置く
+TEXT_CACHE_DIR = os.path.join(app.instance_path, "text_cache")
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "models/gemini-2.0-flash")
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+# nginx で配信する場合の internal location。例:
+#   location /protected-pdfs/ {
+#       internal;
+#       alias /path/to/NoteMate/app/static/uploads/pdfs/;
+#   }
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
 
 CHAT_CATEGORIES = {"free", "term"}
 
+_json_loads = orjson.loads if orjson else json.loads
+
+# Gemini 応答から JSON 部分を取り出すための正規表現（配列部分は find/rfind で切り出す）
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+UPLOAD_COPY_BUFSIZE = 1 << 20
+
+# Gemini に渡す資料本文の最大文字数
+GLOSSARY_MAX_CHARS = 12000
+# 用語抽出プロンプトの固定部分。変数を含めないことで全リクエストで同じ先頭トークン列になる
+GLOSSARY_SYSTEM_PREFIX = (
+    "あなたは大学講義のチューターです。以下の資料本文を読み、重要な専門用語を抽出し、"
+    "それぞれについて学生にも分かりやすい解説を作成してください。"
+    "応答は必ず JSON 配列のみとし、各要素は {\"term\": \"用語\", \"definition\": \"説明\", \"context\": \"資料での文脈\"} の形式で出力してください。"
+)
+
+# PDFium はスレッドセーフではないため、呼び出しを直列化する
+_PDFIUM_LOCK = threading.Lock()
+
+# Gemini 呼び出しなど時間のかかる処理をリクエストスレッドから切り離すためのワーカー
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="notemate-worker")
+_JOBS_LOCK = threading.Lock()
+# lecture_id -> アップロード直後のテキスト事前抽出（_prewarm）の Future
+_PREWARM_JOBS: Dict[str, Future] = {}
+# 用語生成ジョブの状態は DB（glossary_jobs）に置く。これより長く終わらないジョブは処理側が落ちたとみなす
+GLOSSARY_JOB_TIMEOUT = timedelta(minutes=10)
+
 if genai and GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
 
 
+def _now() -> datetime:
+    # DB には epoch マイクロ秒で保存するため、ローカルタイムゾーンを引かずに UTC の aware な時刻を使う
+    return datetime.now(timezone.utc)
+
+
+def _format_local(value: datetime) -> str:
+    # 応答に含める時刻は、DB から読んだ値（ローカルタイムゾーンの ISO 8601）と同じ形式にそろえる
+    return value.astimezone().isoformat()
+
+
 def _allowed_file(filename: str) -> bool:
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in ALLOWED_EXTENSIONS
+    # ".pdf" のように拡張子の前に名前がないものは受け付けない
+    return filename.lower().endswith(ALLOWED_EXTENSIONS) and filename.rfind(".") > 0
 
 
 def _allowed_image(filename: str) -> bool:
@@ -71,52 +140,187 @@ def _allowed_image(filename: str) -> bool:
     return ext.lower() in ALLOWED_IMAGE_EXTENSIONS
 
 
-def _extract_pdf_text(file_path: str, page: int | None = None) -> str:
+def _open_pdf(file_path: str) -> "PdfReader":
     if not PdfReader:
         raise RuntimeError("PyPDF2 がインストールされていません。")
 
-    reader = PdfReader(file_path)
-    if page is not None:
-        if page < 0 or page >= len(reader.pages):
-            raise ValueError("ページ番号が不正です。")
-        return reader.pages[page].extract_text() or ""
+    # PdfReader はスレッドセーフではなく PDF 全体をメモリに抱えるため、呼び出しごとに開いて共有しない
+    return PdfReader(file_path)
+
 
+def _extract_pdf_text_pdfium(file_path: str, page: int | None = None, limit: int | None = None) -> str:
+    # ロックはページ単位で取り、アップロード時のページ数取得などが文書全体の抽出を待たずに済むようにする
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        page_total = len(pdf)
+    try:
+        if page is not None:
+            if page < 0 or page >= page_total:
+                raise ValueError("ページ番号が不正です。")
+            indices = [page]
+        else:
+            indices = range(page_total)
+
+        texts: List[str] = []
+        total = 0
+        for index in indices:
+            with _PDFIUM_LOCK:
+                pdf_page = pdf[index]
+                textpage = pdf_page.get_textpage()
+                try:
+                    texts.append(textpage.get_text_range())
+                finally:
+                    textpage.close()
+                    pdf_page.close()
+            total += len(texts[-1]) + 1
+            if limit is not None and total >= limit:
+                break
+        return "\n".join(texts)
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+
+def _extract_pdf_text(file_path: str, page: int) -> str:
+    # 1 ページ分のテキストを抽出する（文書全体は _extract_pdf_text_limited）。C 実装の PDFium があればそちらを使う
+    if pdfium:
+        return _extract_pdf_text_pdfium(file_path, page)
+
+    reader = _open_pdf(file_path)
+    if page < 0 or page >= len(reader.pages):
+        raise ValueError("ページ番号が不正です。")
+    return reader.pages[page].extract_text() or ""
+
+
+def _extract_pdf_text_limited(file_path: str, max_chars: int = GLOSSARY_MAX_CHARS) -> str:
+    # _generate_glossary は先頭 max_chars 文字しか使わないため、余裕を持たせた文字数に達したら抽出をやめる
+    limit = int(max_chars * 1.2)
+    if pdfium:
+        return _extract_pdf_text_pdfium(file_path, limit=limit)
+
+    reader = _open_pdf(file_path)
     texts: List[str] = []
+    total = 0
     for pdf_page in reader.pages:
         texts.append(pdf_page.extract_text() or "")
+        total += len(texts[-1]) + 1
+        if total >= limit:
+            break
     return "\n".join(texts)
 
 
+def _cached_extract(lecture_id: str, page_key: str, file_path: str, page_index: int | None) -> str:
+    # PDF の更新時刻をファイル名に含め、PDF が置き換わった場合は古いキャッシュを使わない
+    mtime = int(os.path.getmtime(file_path))
+    cache_path = os.path.join(TEXT_CACHE_DIR, f"{lecture_id}_{page_key}_{mtime}.txt")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            return cache_file.read()
+    except FileNotFoundError:
+        pass
+
+    if page_index is None:
+        text = _extract_pdf_text_limited(file_path)
+    else:
+        text = _extract_pdf_text(file_path, page=page_index)
+
+    # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+    os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+        tmp_file.write(text)
+    os.replace(tmp_path, cache_path)
+    return text
+
+
+def _prewarm(file_path: str, lecture_id: str) -> None:
+    # アップロード直後にバックグラウンドで全体テキストを抽出し、初回の用語生成で抽出を待たずに済むようにする
+    try:
+        _cached_extract(lecture_id, "all", file_path, None)
+    except Exception:  # pragma: no cover - 失敗しても用語生成時に改めて抽出する
+        app.logger.warning("テキストの事前抽出に失敗しました: %s", lecture_id, exc_info=True)
+    finally:
+        _discard_if_deleted(lecture_id)
+
+
+def _discard_if_deleted(lecture_id: str) -> None:
+    # 処理中に資料が削除されていたら、削除処理の後に書かれたテキストキャッシュを消しておく
+    if get_pdf_by_id(lecture_id) is None:
+        _remove_text_cache(lecture_id)
+
+
+def _submit_prewarm(file_path: str, lecture_id: str) -> None:
+    future = _EXECUTOR.submit(_prewarm, file_path, lecture_id)
+    with _JOBS_LOCK:
+        _PREWARM_JOBS[lecture_id] = future
+    # 登録後にコールバックを付けるので、即座に完了していても登録が残ることはない
+    future.add_done_callback(lambda _: _forget_prewarm(lecture_id, future))
+
+
+def _forget_prewarm(lecture_id: str, future: Future) -> None:
+    with _JOBS_LOCK:
+        if _PREWARM_JOBS.get(lecture_id) is future:
+            del _PREWARM_JOBS[lecture_id]
+
+
+def _wait_prewarm(lecture_id: str) -> None:
+    # 事前抽出が走っている間に用語生成が始まった場合、同じ PDF を二重に抽出せず完了を待ってキャッシュを使う。
+    # _prewarm は用語生成ジョブより先に同じエグゼキューターへ投入されるため、ここで待っても詰まらない
+    with _JOBS_LOCK:
+        future = _PREWARM_JOBS.get(lecture_id)
+    if future is not None:
+        # _prewarm は例外を握りつぶすので result() が送出することはない
+        future.result()
+
+
+def _remove_text_cache(lecture_id: str) -> None:
+    for cache_path in glob.glob(os.path.join(TEXT_CACHE_DIR, f"{glob.escape(lecture_id)}_*.txt")):
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+
+def _remove_pdf_files(lecture_id: str, file_path: str) -> None:
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # DB の行は削除済みなので、残ったファイルはログに記録するだけにする
+        app.logger.warning("PDFファイルの削除に失敗しました: %s", file_path, exc_info=True)
+    _remove_text_cache(lecture_id)
+
+
 def _get_pdf_page_count(file_path: str) -> int:
-    if not PdfReader:
-        raise RuntimeError("PyPDF2 がインストールされていません。")
+    if pdfium:
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
 
-    reader = PdfReader(file_path)
+    reader = _open_pdf(file_path)
     return len(reader.pages)
 
 
-def _generate_glossary(content: str) -> List[Dict[str, Any]]:
-    if not genai or not GOOGLE_API_KEY:
-        raise RuntimeError("Gemini API が利用できません。GOOGLE_API_KEY を設定してください。")
+def _pdf(lecture_id: str) -> Dict[str, Any] | None:
+    # 同一リクエスト内で同じ資料を何度も引かないよう flask.g にメモする（見つからない場合も記録する）
+    cache = g.setdefault("_pdfs", {})
+    if lecture_id not in cache:
+        cache[lecture_id] = get_pdf_by_id(lecture_id)
+    return cache[lecture_id]
 
-    # Gemini のトークン制限に配慮してテキスト長をサンプリング
-    truncated = content[:12000]
-    prompt = (
-        "あなたは大学講義のチューターです。以下の資料本文を読み、重要な専門用語を抽出し、"
-        "それぞれについて学生にも分かりやすい解説を作成してください。"
-        "応答は必ず JSON 配列のみとし、各要素は {\"term\": \"用語\", \"definition\": \"説明\", \"context\": \"資料での文脈\"} の形式で出力してください。"
-        "資料本文:\n"
-        "```\n"
-        f"{truncated}\n"
-        "```"
-    )
 
-    model = genai.GenerativeModel(GEMINI_MODEL)
-    response = model.generate_content(prompt)
-    text = response.text or ""
+def _forget_pdf(lecture_id: str) -> None:
+    g.setdefault("_pdfs", {}).pop(lecture_id, None)
+
+
+def _parse_glossary_json(text: str) -> List[Dict[str, Any]] | None:
     candidate = text.strip()
 
-    fence_match = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    fence_match = _FENCE_RE.search(text)
     if fence_match:
         candidate = fence_match.group(1).strip()
 
@@ -124,24 +328,53 @@ def _generate_glossary(content: str) -> List[Dict[str, Any]]:
         candidate = text.strip()
 
     try:
-        data = json.loads(candidate)
+        data = _json_loads(candidate)
         if isinstance(data, list):
             return data
     except json.JSONDecodeError:
         # 先頭/末尾の余計な文字を取り除いて再試行
-        bracket_match = re.search(r"\[[\s\S]*\]", candidate)
-        if bracket_match:
+        start = candidate.find("[")
+        end = candidate.rfind("]")
+        if 0 <= start < end:
             try:
-                data = json.loads(bracket_match.group(0))
+                data = _json_loads(candidate[start : end + 1])
                 if isinstance(data, list):
                     return data
             except json.JSONDecodeError:
                 pass
 
-    # Markdown から抽出できなかった場合は生テキストを返す
+    return None
+
+
+def _generate_glossary(content: str, use_cache: bool = True) -> List[Dict[str, Any]]:
+    if not genai or not GOOGLE_API_KEY:
+        raise RuntimeError("Gemini API が利用できません。GOOGLE_API_KEY を設定してください。")
 
+    # Gemini のトークン制限に配慮してテキスト長をサンプリング
+    truncated = content[:GLOSSARY_MAX_CHARS]
+
+    # 同じ本文（再アップロードなど）に対する Gemini 呼び出しを省くため、モデル名・プロンプト・本文のハッシュで応答をキャッシュする
+    cache_key = hashlib.sha256(
+        f"{GEMINI_MODEL}\x00{GLOSSARY_SYSTEM_PREFIX}\x00{truncated}".encode("utf-8")
+    ).hexdigest()
+    if use_cache:
+        cached_items = get_llm_cache(cache_key)
+        if cached_items is not None:
+            return cached_items
+
+    # 固定の指示文と資料本文を別パートで送り、Gemini の暗黙キャッシュが先頭一致で効くようにする
+    user_part = f"資料本文:\n```\n{truncated}\n```"
+
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    response = model.generate_content([GLOSSARY_SYSTEM_PREFIX, user_part])
+    text = response.text or ""
 
-    # JSON に変換できなかった場合でもテキストを返す
+    items = _parse_glossary_json(text)
+    if items is not None:
+        set_llm_cache(cache_key, items, _now())
+        return items
+
+    # JSON に変換できなかった場合でもテキストを返す（キャッシュはしない）
     return [
         {
             "term": "解析失敗",
@@ -200,7 +433,7 @@ def _generate_term_explanation(term: str) -> List[Dict[str, Any]]:
     text = (response.text or "").strip()
 
     candidate = text
-    fence_match = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    fence_match = _FENCE_RE.search(text)
     if fence_match:
         candidate = fence_match.group(1).strip()
 
@@ -208,14 +441,15 @@ def _generate_term_explanation(term: str) -> List[Dict[str, Any]]:
         candidate = text
 
     try:
-        data = json.loads(candidate)
+        data = _json_loads(candidate)
         if isinstance(data, list):
             return data
     except json.JSONDecodeError:
-        bracket_match = re.search(r"\[[\s\S]*\]", candidate)
-        if bracket_match:
+        start = candidate.find("[")
+        end = candidate.rfind("]")
+        if 0 <= start < end:
             try:
-                data = json.loads(bracket_match.group(0))
+                data = _json_loads(candidate[start : end + 1])
                 if isinstance(data, list):
                     return data
             except json.JSONDecodeError:
@@ -232,7 +466,7 @@ def _generate_term_explanation(term: str) -> List[Dict[str, Any]]:
 
 @app.route("/")
 def index():
-    pdfs = get_all_pdfs()
+    pdfs = list_lectures_with_counts()
     return render_template("index.html", pdfs=pdfs)
 
 
@@ -255,14 +489,26 @@ def upload():
 
     os.makedirs(UPLOAD_DIR, exist_ok=True)
     save_path = os.path.join(UPLOAD_DIR, stored_filename)
-    file_storage.save(save_path)
+    # 大きな PDF でもシステムコールが少なく済むよう 1 MiB 単位でコピーする
+    with open(save_path, "wb") as saved_file:
+        shutil.copyfileobj(file_storage.stream, saved_file, length=UPLOAD_COPY_BUFSIZE)
+
+    # ページ数はファイルごとに不変なので、アップロード時に一度だけ数えて保存する
+    page_count: int | None = None
+    try:
+        page_count = _get_pdf_page_count(save_path)
+    except Exception:  # pragma: no cover - 解析できない場合は閲覧時に再試行する
+        page_count = None
 
     insert_pdf(
         lecture_id=lecture_id,
         original_filename=original_filename,
         stored_filename=stored_filename,
-        uploaded_at=datetime.now(),
+        uploaded_at=_now(),
+        page_count=page_count,
     )
+    if pdfium or PdfReader:
+        _submit_prewarm(save_path, lecture_id)
 
     flash("講義資料をアップロードしました。", "success")
     return redirect(url_for("view_pdf", lecture_id=lecture_id))
@@ -270,69 +516,77 @@ def upload():
 
 @app.route("/lectures/<lecture_id>")
 def view_pdf(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         flash("指定された資料が見つかりませんでした。", "error")
         return redirect(url_for("index"))
 
     pdf_url = url_for("static", filename=f"uploads/pdfs/{pdf['stored_filename']}")
-    file_path = os.path.join(UPLOAD_DIR, pdf["stored_filename"])
-    page_count = 0
-    try:
-        if os.path.exists(file_path):
-            page_count = _get_pdf_page_count(file_path)
-    except RuntimeError:
+    page_count = pdf.get("page_count")
+    if page_count is None:
+        # ページ数未保存の資料は初回閲覧時に数えて保存する
         page_count = 0
+        file_path = os.path.join(UPLOAD_DIR, pdf["stored_filename"])
+        try:
+            if os.path.exists(file_path):
+                page_count = _get_pdf_page_count(file_path)
+                update_pdf_page_count(lecture_id, page_count)
+                _forget_pdf(lecture_id)
+        except RuntimeError:
+            page_count = 0
 
     return render_template("view_pdf.html", pdf=pdf, pdf_url=pdf_url, page_count=page_count)
 
 
+def _download_etag(pdf: Dict[str, Any]) -> str:
+    # 保存ファイルは UUID 名で内容が変わらないが、ダウンロード名は変更されうるので ETag に含める
+    key = f"{pdf['stored_filename']}\x00{pdf['original_filename']}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
 @app.route("/lectures/<lecture_id>/download")
 def download_pdf(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         flash("指定された資料が見つかりませんでした。", "error")
         return redirect(url_for("index"))
-    return send_from_directory(
+    response = send_from_directory(
         UPLOAD_DIR,
         pdf["stored_filename"],
         as_attachment=True,
         download_name=pdf["original_filename"],
+        conditional=True,
+        etag=_download_etag(pdf),
     )
+    # 名前変更や削除をすぐ反映させるため毎回再検証させ、変化がなければ 304 で本文の再送を省く。
+    # 講義資料を共有キャッシュに残さないよう private にする
+    response.headers["Cache-Control"] = "private, no-cache"
+    # app.use_x_sendfile が有効な場合、本文は空で X-Sendfile ヘッダーだけが付く。nginx 向けには差し替える
+    if X_ACCEL_REDIRECT_PREFIX and "X-Sendfile" in response.headers:
+        del response.headers["X-Sendfile"]
+        response.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{pdf['stored_filename']}"
+    return response
 
 
 @app.route("/lectures/<lecture_id>/delete", methods=["POST"])
 def delete_pdf(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         flash("指定された資料が見つかりませんでした。", "error")
         return redirect(url_for("index"))
 
-    file_path = os.path.join(UPLOAD_DIR, pdf["stored_filename"])
-    file_error: str | None = None
-
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except OSError as err:
-        file_error = str(err)
-
+    # 先に DB の行を消してから、ファイル削除はバックグラウンドで行う（途中で落ちても孤立した行が残らない）
     delete_pdf_record(lecture_id)
+    _forget_pdf(lecture_id)
+    _EXECUTOR.submit(_remove_pdf_files, lecture_id, os.path.join(UPLOAD_DIR, pdf["stored_filename"]))
 
-    if file_error:
-        flash(
-            f"資料を削除しましたが、ファイルの削除でエラーが発生しました: {file_error}",
-            "error",
-        )
-    else:
-        flash("講義資料を削除しました。", "success")
-
+    flash("講義資料を削除しました。", "success")
     return redirect(url_for("index"))
 
 
 @app.route("/lectures/<lecture_id>/rename", methods=["POST"])
 def rename_pdf(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -345,18 +599,18 @@ def rename_pdf(lecture_id: str):
     if len(new_name) > 255:
         return jsonify({"error": "ファイル名は255文字以内で入力してください。"}), 400
 
-    _, ext = os.path.splitext(new_name)
-    if ext.lower() not in ALLOWED_EXTENSIONS:
+    if not _allowed_file(new_name):
         allowed = ", ".join(sorted(ALLOWED_EXTENSIONS))
         return jsonify({"error": f"ファイル名は次の拡張子で終わる必要があります: {allowed}"}), 400
 
     update_pdf_filename(lecture_id, new_name)
+    _forget_pdf(lecture_id)
     return jsonify({"lecture_id": lecture_id, "original_filename": new_name})
 
 
 @app.route("/lectures/<lecture_id>/dictionary", methods=["GET", "POST"])
 def glossary_dictionary(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -376,7 +630,7 @@ def glossary_dictionary(lecture_id: str):
         return jsonify({"error": "解説が入力されていません。"}), 400
 
     dictionary_id = uuid.uuid4().hex
-    saved_at = datetime.now()
+    saved_at = _now()
     upsert_glossary_dictionary_item(
         dictionary_id,
         lecture_id,
@@ -392,15 +646,55 @@ def glossary_dictionary(lecture_id: str):
         "term": term,
         "definition": definition,
         "context": context,
-        "saved_at": saved_at.isoformat(),
+        "saved_at": _format_local(saved_at),
     }
 
     return jsonify({"item": item})
 
 
+def _run_glossary_job(
+    job_id: str, lecture_id: str, page_key: str, file_path: str, page_index: int | None, refresh: bool
+) -> None:
+    try:
+        if page_key == "all":
+            # 事前抽出が作るのは文書全体のテキストだけなので、ページ単位の解析では待たない
+            _wait_prewarm(lecture_id)
+        content = _cached_extract(lecture_id, page_key, file_path, page_index)
+        if not content.strip():
+            raise RuntimeError("PDFからテキストを抽出できませんでした。")
+        # refresh 指定時は LLM 応答キャッシュも使わずに再生成する
+        glossary_items = _generate_glossary(content, use_cache=not refresh)
+        if upsert_glossary_cache(lecture_id, page_key, glossary_items, _now()):
+            finish_glossary_job(job_id)
+        else:
+            finish_glossary_job(job_id, "資料が見つかりませんでした。", 404)
+    except RuntimeError as err:
+        finish_glossary_job(job_id, str(err), 500)
+    except ValueError as err:
+        finish_glossary_job(job_id, str(err), 400)
+    except Exception as err:  # pragma: no cover - 想定外エラー
+        finish_glossary_job(job_id, f"AI解析中にエラーが発生しました: {err}", 500)
+    finally:
+        _discard_if_deleted(lecture_id)
+
+
+def _submit_glossary_job(
+    lecture_id: str, page_key: str, file_path: str, page_index: int | None, refresh: bool
+) -> str:
+    with _JOBS_LOCK:
+        # 同じ条件の解析が進行中ならそのジョブを返し、Gemini を二重に呼ばない（refresh の有無も条件に含める）
+        job_id = find_pending_glossary_job(lecture_id, page_key, refresh, _now() - GLOSSARY_JOB_TIMEOUT)
+        if job_id:
+            return job_id
+        job_id = uuid.uuid4().hex
+        insert_glossary_job(job_id, lecture_id, page_key, refresh, _now())
+    _EXECUTOR.submit(_run_glossary_job, job_id, lecture_id, page_key, file_path, page_index, refresh)
+    return job_id
+
+
 @app.route("/lectures/<lecture_id>/glossary")
 def glossary(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -424,24 +718,35 @@ def glossary(lecture_id: str):
         if cached:
             return jsonify({"items": cached["items"], "cached": True, "updated_at": cached["updated_at"]})
 
-    try:
-        content = _extract_pdf_text(file_path, page=page_index)
-        if not content.strip():
-            return jsonify({"error": "PDFからテキストを抽出できませんでした。"}), 500
-        glossary_items = _generate_glossary(content)
-        upsert_glossary_cache(lecture_id, page_key, glossary_items, datetime.now())
-        return jsonify({"items": glossary_items, "cached": False})
-    except RuntimeError as err:
-        return jsonify({"error": str(err)}), 500
-    except ValueError as err:
-        return jsonify({"error": str(err)}), 400
-    except Exception as err:  # pragma: no cover - 想定外エラー
-        return jsonify({"error": f"AI解析中にエラーが発生しました: {err}"}), 500
+    job_id = _submit_glossary_job(lecture_id, page_key, file_path, page_index, bool(refresh))
+    status_url = url_for("glossary_status", lecture_id=lecture_id, job_id=job_id)
+    return jsonify({"job_id": job_id, "status": "pending", "status_url": status_url}), 202
+
+
+@app.route("/lectures/<lecture_id>/glossary/status")
+def glossary_status(lecture_id: str):
+    job_id = request.args.get("job_id", "")
+    job = get_glossary_job(job_id)
+    if not job or job["lecture_id"] != lecture_id:
+        return jsonify({"error": "指定されたジョブが見つかりませんでした。"}), 404
+
+    if job["status"] == "pending":
+        if datetime.fromisoformat(job["created_at"]) < _now() - GLOSSARY_JOB_TIMEOUT:
+            return jsonify({"error": "AI解析がタイムアウトしました。もう一度お試しください。"}), 500
+        return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+    if job["status"] == "error":
+        return jsonify({"error": job["error"]}), job["error_code"] or 500
+
+    cached = get_glossary_cache(lecture_id, job["page_key"])
+    if not cached:
+        return jsonify({"error": "資料が見つかりませんでした。"}), 404
+    return jsonify({"items": cached["items"], "cached": False, "updated_at": cached["updated_at"]})
 
 
 @app.route("/lectures/<lecture_id>/note", methods=["GET", "POST"])
 def note_api(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -456,13 +761,13 @@ def note_api(lecture_id: str):
     if content is None:
         return jsonify({"error": "content が指定されていません。"}), 400
 
-    upsert_note_for_lecture(lecture_id, str(content), datetime.now())
+    upsert_note_for_lecture(lecture_id, str(content), _now())
     return jsonify({"status": "ok"})
 
 
 @app.route("/lectures/<lecture_id>/chat", methods=["GET", "POST", "DELETE"])
 def chat_api(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -488,9 +793,8 @@ def chat_api(lecture_id: str):
     if not user_message:
         return jsonify({"error": "メッセージを入力してください。"}), 400
 
-    created_at = datetime.now()
+    created_at = _now()
     user_message_id = uuid.uuid4().hex
-    insert_chat_message(lecture_id, user_message_id, "user", user_message, created_at, category=category)
 
     assistant_reply: str
     reply_items: List[Dict[str, Any]] | None = None
@@ -509,20 +813,20 @@ def chat_api(lecture_id: str):
         reply_items = items
         assistant_reply = json.dumps(items, ensure_ascii=False)
     else:
-        history = list_chat_messages(lecture_id, category=category)
+        # ユーザー発言は応答と一緒に保存するため、履歴には手元で追加する
+        history = list_chat_messages(lecture_id, limit=9, category=category)
+        history.append({"role": "user", "content": user_message})
         try:
             assistant_reply = _generate_chat_reply(history, user_message)
         except Exception as err:  # pragma: no cover - 想定外エラー
             assistant_reply = f"回答生成中にエラーが発生しました: {err}"
 
     assistant_message_id = uuid.uuid4().hex
-    insert_chat_message(
-        lecture_id,
-        assistant_message_id,
-        "assistant",
-        assistant_reply,
-        datetime.now(),
-        category=category,
+    insert_chat_messages_many(
+        [
+            (lecture_id, user_message_id, "user", user_message, created_at, category),
+            (lecture_id, assistant_message_id, "assistant", assistant_reply, _now(), category),
+        ]
     )
 
     messages = list_chat_messages(lecture_id, category=category)
@@ -534,7 +838,7 @@ def chat_api(lecture_id: str):
 
 @app.route("/lectures/<lecture_id>/note/images", methods=["GET", "POST"])
 def note_images_api(lecture_id: str):
-    pdf = get_pdf_by_id(lecture_id)
+    pdf = _pdf(lecture_id)
     if not pdf:
         return jsonify({"error": "資料が見つかりませんでした。"}), 404
 
@@ -561,7 +865,7 @@ def note_images_api(lecture_id: str):
     save_path = os.path.join(NOTE_IMAGE_DIR, stored_filename)
     file_storage.save(save_path)
 
-    uploaded_at = datetime.now()
+    uploaded_at = _now()
     insert_note_image(lecture_id, image_id, original_filename, stored_filename, uploaded_at)
 
     image_url = url_for("static", filename=f"uploads/note_images/{stored_filename}")
@@ -571,7 +875,7 @@ def note_images_api(lecture_id: str):
             "image_id": image_id,
             "original_filename": original_filename,
             "stored_filename": stored_filename,
-            "uploaded_at": uploaded_at.isoformat(),
+            "uploaded_at": _format_local(uploaded_at),
             "url": image_url,
             "markdown": markdown,
         }